@@ -3,47 +3,106 @@
 # Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
 # Distributed under the terms of the 3-clause BSD License.
 
+import base64
+import functools
+import hashlib
+import json
+import marshal
 import pickle
+import weakref
+from collections import OrderedDict
+from importlib.util import MAGIC_NUMBER
 
 from sos.eval import interpolate
-from sos.utils import env, short_repr
+from sos.parser import replace_sigil
+from sos.utils import as_fstring, env, short_repr
 
 #
 # These functions will be imported by both Python2 and Python3 and cannot
 # use any python3-specific syntax (e.g. f-string)
 #
 __init_statement__ = r'''
-from collections.abc import Sized, KeysView, Sequence
+try:
+    from collections.abc import Sized, KeysView, Sequence
+except ImportError:
+    # Python 2
+    from collections import Sized, KeysView, Sequence
 from types import ModuleType
-import pydoc
+from itertools import islice
 import pickle
 
+__version_cache__ = {}
+
 def __version_info__(module):
-    # return the version of Python module
+    # return the version of Python module, which is cached because it is
+    # queried for all loaded modules by %sessioninfo
+    if module not in __version_cache__:
+        __version_cache__[module] = __find_version(module)
+    return __version_cache__[module]
+
+
+def __find_version(module):
+    import sys
+    ver = getattr(sys.modules.get(module), '__version__', None)
+    if ver is not None:
+        return str(ver)
     try:
-        code = ("import %s; version=str(%s.__version__)" %
-                (module, module))
-        ns_g = ns_l = {}
-        exec(compile(code, "<string>", "exec"), ns_g, ns_l)
-        return ns_l["version"]
-    except Exception as e:
-        import pkg_resources
+        from importlib.metadata import version
+    except ImportError:
+        # Python 2 and Python 3 before 3.8
         try:
+            import pkg_resources
             return pkg_resources.require(module)[0].version
         except Exception as e:
             return 'na'
+    try:
+        return version(module)
+    except Exception as e:
+        return 'na'
 
 
 def __loaded_modules__():
-    from types import ModuleType
-    res = []
-    for key,value in globals().items():
-        if isinstance(value, ModuleType):
-            res.append([value.__name__, __version_info__(value.__name__)])
-    return [(x,y) for x,y in res if y != 'na']
+    # modules imported under several aliases are reported once
+    names = set(x.__name__ for x in globals().values() if isinstance(x, ModuleType))
+    res = [(x, __version_info__(x)) for x in sorted(names)]
+    return [(x, y) for x, y in res if y != 'na']
 
 
-def __short_repr(obj):
+# beginning of the repr of containers on Python 3. It is not used on Python 2,
+# where sets are shown as set([...]) and dict values and items are lists.
+__repr_prefix = {}
+if str is not bytes:
+    __repr_prefix = {
+        set: '{',
+        frozenset: 'frozenset({',
+        type({}.values()): 'dict_values([',
+        type({}.items()): 'dict_items([',
+    }
+    # repr of items limited in length and nesting, so that large items are
+    # not converted entirely
+    class __ItemRepr(__import__('reprlib').Repr):
+        # reprlib sorts sets, which walks all their items
+        def repr_set(self, x, level):
+            if not x:
+                return 'set()'
+            return self._repr_iterable(x, level, '{', '}', self.maxset)
+
+        def repr_frozenset(self, x, level):
+            if not x:
+                return 'frozenset()'
+            return self._repr_iterable(x, level, 'frozenset({', '})', self.maxfrozenset)
+
+    __item_repr = __ItemRepr()
+    __item_repr.maxlevel = 2
+    __item_repr.maxstring = __item_repr.maxother = __item_repr.maxlong = 40
+    __item_repr.maxlist = __item_repr.maxtuple = __item_repr.maxdict = 20
+    __item_repr.maxset = __item_repr.maxfrozenset = __item_repr.maxdeque = __item_repr.maxarray = 20
+
+def __short_repr(obj, depth=0):
+    # only the first items of containers are visited, and containers nested
+    # more than two levels deep are abbreviated to their number of items
+    # unless they are small, so that the cost does not depend on the size or
+    # depth of the object
     if obj is None:
         return 'None'
     elif isinstance(obj, str) and len(obj) > 80:
@@ -53,31 +112,46 @@ def __short_repr(obj):
         return repr(obj)
     elif hasattr(obj, '__short_repr__'):
         return obj.__short_repr__()
-    elif isinstance(obj, Sequence):  # should be a list or tuple
+    elif depth > 1 and isinstance(obj, (Sequence, dict, KeysView)) and \
+            (len(obj) > 2 or (depth > 2 and len(obj) > 0)):
+        # small containers are still shown at the third level, but only with
+        # items that are not containers themselves
+        if len(obj) == 1:
+            return '...'
+        return '... (' + str(len(obj)) + ' items)'
+    elif isinstance(obj, (list, tuple)) or isinstance(obj, Sequence):
+        # lists and tuples are checked first to skip the slower ABC check
         if len(obj) == 0:
             return '[]'
-        elif len(obj) == 1:
-            return __short_repr(obj[0])
-        elif len(obj) == 2:
-            return __short_repr(obj[0]) + ', ' + __short_repr(obj[1])
-        else:
-            return __short_repr(obj[0]) + ', ' + __short_repr(obj[1]) + ', ... (' + str(len(obj)) + ' items)'
+        ret = ', '.join(__short_repr(x, depth + 1) for x in islice(obj, 2))
+        if len(obj) > 2:
+            ret += ', ... (' + str(len(obj)) + ' items)'
+        return ret
     elif isinstance(obj, dict):
         if not obj:
             return ''
-        elif len(obj) == 1:
-            first_key = list(obj.keys())[0]
-            return __short_repr(repr(first_key)) + ':' + __short_repr(obj[first_key])
+        first_key, first_val = next(iter(obj.items()))
+        if len(obj) == 1:
+            return __short_repr(repr(first_key), depth + 1) + ':' + __short_repr(first_val, depth + 1)
         else:
-            first_key = list(obj.keys())[0]
-            return __short_repr(first_key) + ':' + __short_repr(obj[first_key]) + ', ... (' + str(len(obj)) + ' items)'
+            return __short_repr(first_key, depth + 1) + ':' + __short_repr(first_val, depth + 1) + ', ... (' + str(len(obj)) + ' items)'
     elif isinstance(obj, KeysView):
         if not obj:
             return ''
         elif len(obj) == 1:
-            return __short_repr(next(iter(obj)))
+            return __short_repr(next(iter(obj)), depth + 1)
         else:
-            return __short_repr(next(iter(obj))) + ', ... (' + str(len(obj)) + ' items)'
+            return __short_repr(next(iter(obj)), depth + 1) + ', ... (' + str(len(obj)) + ' items)'
+    elif type(obj) in __repr_prefix and len(obj) > 35:
+        # the repr of these containers is longer than 40 characters, and its
+        # first 35 characters are built from the limited repr of the first
+        # items, without walking the entire container or large items
+        ret = __repr_prefix[type(obj)]
+        for idx, x in enumerate(obj):
+            if len(ret) >= 35:
+                break
+            ret += (', ' if idx else '') + __item_repr.repr(x)
+        return ret[:35] + '...'
     else:
         ret = str(obj)
         if len(ret) > 40:
@@ -87,11 +161,12 @@ def __short_repr(obj):
 
 
 def __preview_var(item):
-    # check if 'item' is in the subkernel
-    if item not in globals():
-        return '', f'Unknown variable {item}'
-
-    obj = eval(item)
+    # only variables of the subkernel can be previewed, and looking them up
+    # directly avoids compiling item as an expression
+    try:
+        obj = globals()[item]
+    except KeyError:
+        return '', 'Unknown variable {}'.format(item)
 
     # get the basic information of object
     txt = type(obj).__name__
@@ -101,14 +176,30 @@ def __preview_var(item):
         txt += ' of shape ' + str(getattr(obj, "shape"))
     elif isinstance(obj, Sized):
         txt += ' of length ' + str(obj.__len__())
-    if isinstance(obj, ModuleType):
-        return txt, ({
-            'text/plain': pydoc.render_doc(obj, renderer=pydoc.plaintext)
-        }, {})
-    elif callable(obj):
-        return txt, ({
-            'text/plain': pydoc.render_doc(obj, renderer=pydoc.plaintext)
-        }, {})
+    if isinstance(obj, ModuleType) or callable(obj):
+        # show the signature and the beginning of the docstring instead of
+        # rendering the documentation of all members with pydoc, which can
+        # take long for large modules and classes
+        doc = str(getattr(obj, '__doc__', None) or '').strip()
+        if len(doc) > 4000:
+            doc = doc[:4000] + '\n...'
+        if isinstance(obj, ModuleType):
+            names = [] if doc else sorted(x for x in dir(obj) if not x.startswith('_'))
+            if names:
+                # list the public names of modules without docstring
+                doc = 'Contents: ' + ', '.join(names[:50])
+                if len(names) > 50:
+                    doc += ', ... (' + str(len(names)) + ' names)'
+        else:
+            try:
+                import inspect
+                # callable instances have no __name__
+                name = getattr(obj, '__name__', None) or type(obj).__name__
+                doc = (name + str(inspect.signature(obj)) + '\n\n' + doc).strip()
+            except Exception as e:
+                # builtins without signature and Python 2
+                pass
+        return txt, ({'text/plain': doc}, {})
     elif hasattr(obj, 'to_html') and getattr(obj, 'to_html') is not None:
         try:
             html = obj.to_html()
@@ -119,12 +210,151 @@ def __preview_var(item):
         return txt, __short_repr(obj)
 
 def __repr_var(item):
-    if item not in globals():
-        raise ValueError(f'Undefined variable {item}')
-    return repr(eval(item))
+    try:
+        return repr(globals()[item])
+    except KeyError:
+        raise ValueError('Undefined variable {}'.format(item))
+
+
+__sos_cache__ = {}
+
+def __sos_load_vars(digest, pickled, buffers, drop):
+    # restore variables from their pickle and its out-of-band buffers, which
+    # are encoded in base64. Payloads sent with a digest are kept decoded in
+    # __sos_cache__ and are not sent again, in which case pickled is None.
+    # Digests in drop are removed from the cache, or the whole cache if drop
+    # is None.
+    import base64
+    if pickled is None:
+        pickled, buffers = __sos_cache__[digest]
+    else:
+        pickled = base64.b64decode(pickled)
+        buffers = [base64.b64decode(x) for x in buffers]
+        if digest is not None:
+            __sos_cache__[digest] = (pickled, buffers)
+    if drop is None:
+        __sos_cache__.clear()
+    for x in drop or []:
+        __sos_cache__.pop(x, None)
+    if buffers:
+        # restored as bytearray so that the unpickled arrays remain writable
+        globals().update(pickle.loads(pickled, buffers=[bytearray(x) for x in buffers]))
+    else:
+        globals().update(pickle.loads(pickled))
+
+
+def __is_literal(obj):
+    # whether obj is small and consists only of basic types so that repr(obj)
+    # recreates it exactly. Shared or recursive containers are rejected because
+    # their repr would not preserve the references, and long strings and large
+    # integers are rejected because their repr is larger than their pickle.
+    stack = [obj]
+    seen = set()
+    count = 0
+    length = 0
+    while stack:
+        count += 1
+        if count > 1000:
+            return False
+        x = stack.pop()
+        if type(x) in (list, tuple, dict):
+            if id(x) in seen:
+                return False
+            seen.add(id(x))
+            if type(x) is dict:
+                stack.extend(x.keys())
+                stack.extend(x.values())
+            else:
+                stack.extend(x)
+        elif type(x) in (str, bytes):
+            length += len(x)
+            if length > 4096:
+                return False
+        elif type(x) is int:
+            if x.bit_length() > 1024:
+                return False
+        elif type(x) is float:
+            if x != x or x in (float('inf'), float('-inf')):
+                return False
+        elif type(x) not in (bool, type(None)):
+            return False
+    return True
+
+
+def __put_vars(items, protocol, literal):
+    # write variables to stdout, as repr (which starts with '{') if literal
+    # is allowed and they can be recreated from it, and otherwise as
+    # base64-encoded pickle, which is smaller than repr of the pickled bytes
+    import base64
+    import sys
+    if literal and __is_literal(items):
+        try:
+            sys.stdout.write(repr(items))
+            return
+        except ValueError:
+            # repr of int can be limited by sys.set_int_max_str_digits
+            pass
+    sys.stdout.write(base64.b64encode(pickle.dumps(items, protocol)).decode())
+
+
+__fstring_cache = {}
+
+def __eval_fstring(source):
+    # evaluate f-string source, keeping the compiled code of recent sources
+    if source not in __fstring_cache:
+        if len(__fstring_cache) >= 256:
+            __fstring_cache.clear()
+        __fstring_cache[source] = compile(source, '<expand>', 'eval')
+    return eval(__fstring_cache[source], globals())
+
+
+def __dump_preview(item, protocol):
+    return pickle.dumps(__preview_var(item), protocol)
+
+
+def __session_info():
+    # session info only contains strings and is returned as json
+    import json
+    import sys
+    res = [("Version", sys.version)]
+    res.extend(__loaded_modules__())
+    return json.dumps(res)
 
 '''
 
+# the init statement is compiled once and sent to Python 3 subkernels as a
+# marshalled code object, which is only used if the subkernel has the same
+# bytecode version as SoS, and is otherwise compiled from source as before
+_INIT_CODE_PY3 = compile(__init_statement__, '<sos_python_init>', 'exec')
+_INIT_STATEMENT_PY3 = f"""\
+if __import__('importlib.util').util.MAGIC_NUMBER == {MAGIC_NUMBER!r}:
+    exec(__import__('marshal').loads({marshal.dumps(_INIT_CODE_PY3)!r}))
+else:
+    exec({__init_statement__!r})
+"""
+
+# pickle protocol agreed with each subkernel, keyed by its kernel client so
+# that a restarted subkernel is queried again
+_protocols = weakref.WeakKeyDictionary()
+
+# digests and sizes of the payloads cached by each Python 3 subkernel, in the
+# order of their last use. Only large payloads that are sent a second time are
+# cached, so the digests of the last payloads sent once are also kept, and the
+# oldest cached payloads are dropped when their total size exceeds _CACHE_SIZE.
+_cached_payloads = weakref.WeakKeyDictionary()
+_sent_payloads = weakref.WeakKeyDictionary()
+_CACHE_MIN_SIZE = 2**20
+_CACHE_SIZE = 2**26
+
+
+@functools.lru_cache(maxsize=256)
+def _expand_statement(text, sigil):
+    # text with sigil replaced, and the statement that evaluates it as an
+    # f-string in the subkernel, cached for cells that are expanded repeatedly
+    if sigil != '{ }':
+        text = replace_sigil(text, sigil)
+    return text, f'__eval_fstring({as_fstring(text)!r})'
+
 
 class sos_Python:
     supported_kernels = {'Python3': ['python3'], 'Python2': ['python2']}
@@ -139,19 +369,114 @@ class sos_Python:
     def __init__(self, sos_kernel, kernel_name='python3'):
         self.sos_kernel = sos_kernel
         self.kernel_name = kernel_name
-        self.init_statements = __init_statement__
+        if kernel_name == 'python3':
+            self.init_statements = _INIT_STATEMENT_PY3
+        else:
+            self.init_statements = __init_statement__
 
     async def get_vars(self, names, as_var=None):
+        # send all variables in a single pickle and a single cell so that
+        # K variables cost one round-trip to the subkernel instead of K
+        try:
+            stmt = self._load_statement({as_var if as_var else name: env.sos_dict[name] for name in names})
+        except Exception as e:
+            env.log_to_file('VARIABLE', f'Failed to pickle {names} as a batch: {e}')
+        else:
+            res = await self.sos_kernel.run_cell(
+                stmt, True, False, on_error=f'Failed to get variable {", ".join(names)} from SoS to {self.kernel_name}')
+            if not isinstance(res, dict) or res.get('status', 'ok') == 'ok':
+                return
+        # fallback to one variable at a time so that errors are reported per variable,
+        # without relying on payloads cached by the subkernel
         for name in names:
-            if self.kernel_name == 'python3':
-                dumped = pickle.dumps({as_var if as_var else name: env.sos_dict[name]})
-                stmt = f"globals().update(pickle.loads({dumped!r}))\n"
-            else:
-                dumped = pickle.dumps({as_var if as_var else name: env.sos_dict[name]}, protocol=2, fix_imports=True)
-                stmt = f"globals().update(pickle.loads({dumped!r}))\n"
+            try:
+                stmt = self._load_statement({as_var if as_var else name: env.sos_dict[name]}, use_cache=False)
+            except Exception as e:
+                self.sos_kernel.warn(f'Failed to get variable {name} from SoS to {self.kernel_name}: {e}')
+                continue
             await self.sos_kernel.run_cell(
                 stmt, True, False, on_error=f'Failed to get variable {name} from SoS to {self.kernel_name}')
 
+    def _pickle_protocol(self):
+        # highest pickle protocol understood by both SoS and the subkernel
+        if self.kernel_name != 'python3':
+            return 2
+        kc = self.sos_kernel.KC
+        if kc not in _protocols:
+            try:
+                response = self.sos_kernel.get_response('import pickle;pickle.HIGHEST_PROTOCOL',
+                                                        ['execute_result'])[-1][1]
+                _protocols[kc] = min(pickle.HIGHEST_PROTOCOL, int(response['data']['text/plain']))
+            except Exception as e:
+                # protocol 4 is understood by all supported versions of Python 3
+                env.log_to_file('VARIABLE', f'Failed to get pickle protocol of {self.kernel_name}: {e}')
+                _protocols[kc] = 4
+        return _protocols[kc]
+
+    def _load_statement(self, objects, use_cache=True):
+        # statement that restores pickled objects into the globals of the subkernel.
+        # Payloads are encoded in base64, which unlike repr(bytes) does not need
+        # escaping, and the statement is joined from parts so that the potentially
+        # large payloads are copied only once.
+        if self.kernel_name != 'python3':
+            dumped = pickle.dumps(objects, protocol=2, fix_imports=True)
+            return ''.join([
+                "import base64;globals().update(pickle.loads(base64.b64decode('",
+                base64.b64encode(dumped).decode(), "')))\n"
+            ])
+        protocol = self._pickle_protocol()
+        # with protocol 5, large buffers such as numpy arrays are not copied into the
+        # pickle stream but are sent out-of-band as base64 strings
+        buffers = []
+        if protocol >= 5:
+            dumped = pickle.dumps(objects, protocol=protocol, buffer_callback=buffers.append)
+        else:
+            dumped = pickle.dumps(objects, protocol=protocol)
+        buffers = [buf.raw() for buf in buffers]
+        digest, cached, dropped = self._cache_payload(dumped, buffers, use_cache)
+        if cached:
+            return f'__sos_load_vars({digest!r}, None, [], {dropped!r})\n'
+        parts = [f"__sos_load_vars({digest!r}, '", base64.b64encode(dumped).decode(), "', ["]
+        for buf in buffers:
+            parts.extend(["'", base64.b64encode(buf).decode(), "', "])
+        parts.append(f'], {dropped!r})\n')
+        return ''.join(parts)
+
+    def _cache_payload(self, dumped, buffers, use_cache):
+        # returns the digest under which the subkernel caches the payload (None if
+        # it is not to be cached), whether the payload is already cached, and the
+        # digests to be dropped from the cache (None to clear the cache)
+        cached = _cached_payloads.setdefault(self.sos_kernel.KC, OrderedDict())
+        sent = _sent_payloads.setdefault(self.sos_kernel.KC, OrderedDict())
+        if not use_cache:
+            cached.clear()
+            sent.clear()
+            return None, False, None
+        size = len(dumped) + sum(buf.nbytes for buf in buffers)
+        if not _CACHE_MIN_SIZE <= size <= _CACHE_SIZE:
+            return None, False, []
+        # payloads are identified by content so that a variable that has been
+        # changed or rebound in SoS is never taken from the cache
+        sha = hashlib.sha1(dumped)
+        for buf in buffers:
+            sha.update(buf)
+        digest = sha.hexdigest()
+        if digest in cached:
+            cached.move_to_end(digest)
+            return digest, True, []
+        if digest not in sent:
+            # payloads sent only once are not cached
+            sent[digest] = None
+            if len(sent) > 16:
+                sent.popitem(last=False)
+            return None, False, []
+        del sent[digest]
+        cached[digest] = size
+        dropped = []
+        while sum(cached.values()) > _CACHE_SIZE:
+            dropped.append(cached.popitem(last=False)[0])
+        return digest, False, dropped
+
     def load_pickled(self, item):
         if isinstance(item, bytes):
             return pickle.loads(item)
@@ -162,20 +487,32 @@ class sos_Python:
 
     def put_vars(self, items, to_kernel=None, as_var=None):
         item_expr = ','.join(f'"{as_var if as_var else x}":{x}' for x in items)
-        stmt = f'__vars__={{ {item_expr} }}\npickle.dumps(__vars__)'
+        same_language = (self.kernel_name == 'python3' and to_kernel == 'Python3') or \
+            (self.kernel_name == 'python2' and to_kernel == 'Python2')
+        protocol = self._pickle_protocol()
+        if same_language:
+            # the destination kernel might run an older version of Python 3, which
+            # can read protocol 4 but not necessarily a protocol negotiated with SoS
+            protocol = min(protocol, 4)
+        stmt = f'__put_vars({{ {item_expr} }}, {protocol}, {same_language})'
         try:
-            # sometimes python2 kernel would fail to send a execute_result and lead to an error
-            response = self.sos_kernel.get_response(stmt, ['execute_result'])[-1][1]
+            responses = self.sos_kernel.get_response(stmt, ['stream'], name=('stdout',))
         except:
             return {}
+        if not responses:
+            return {}
+        # the output can be sent in several stream messages
+        encoded = ''.join(x[1]['text'] for x in responses)
 
         # Python3 -> Python3
-        if (self.kernel_name == 'python3' and to_kernel == 'Python3') or \
-                (self.kernel_name == 'python2' and to_kernel == 'Python2'):
+        if same_language:
             # to self, this should allow all variables to be passed
-            return f"import pickle;globals().update(pickle.loads({response['data']['text/plain']}))"
+            if encoded.startswith('{'):
+                # small variables of basic types are passed as literals
+                return f"globals().update({encoded})"
+            return ''.join(["import pickle, base64;globals().update(pickle.loads(base64.b64decode('", encoded, "')))"])
         try:
-            ret = self.load_pickled(eval(response['data']['text/plain']))
+            ret = self.load_pickled(base64.b64decode(encoded))
             if self.sos_kernel._debug_mode:
                 self.sos_kernel.warn(f'Get: {ret}')
             return ret
@@ -184,29 +521,29 @@ class sos_Python:
             return {}
 
     def expand(self, text, sigil):
-        if sigil != '{ }':
-            from sos.parser import replace_sigil
-            text = replace_sigil(text, sigil)
-
+        text, stmt = _expand_statement(text, sigil)
         try:
-            from sos.utils import as_fstring
-            response = self.sos_kernel.get_response(as_fstring(text), ['execute_result'])[-1][1]
+            # errors are captured by the same request so that the expression is
+            # evaluated only once
+            msg_type, response = self.sos_kernel.get_response(stmt, ('execute_result', 'error'))[-1]
+            if msg_type == 'error':
+                self.sos_kernel.warn(f'Failed to expand "{text}": {response["evalue"]}')
+                return text
             return eval(response['data']['text/plain'])
-        except Exception:
-            err_msg = self.sos_kernel.get_response(as_fstring(text), ('error',), name=('evalue',))[0][1]['evalue']
-            self.sos_kernel.warn(f'Failed to expand "{text}": {err_msg}')
+        except Exception as e:
+            self.sos_kernel.warn(f'Failed to expand "{text}": {e}')
             return text
 
     def preview(self, item):
         try:
-            response = self.sos_kernel.get_response(f'pickle.dumps(__preview_var("{item}"))', ['execute_result'])[-1][1]
+            response = self.sos_kernel.get_response(f'__dump_preview({item!r}, {self._pickle_protocol()})',
+                                                ['execute_result'])[-1][1]
             return self.load_pickled(eval(response['data']['text/plain']))
         except Exception as e:
             env.log_to_file('PREVIEW', f'Failed to preview {item}: {e}')
             return '', f'No preview is available {e}'
 
     def sessioninfo(self):
-        modules = self.sos_kernel.get_response(
-            'import pickle;import sys;res=[("Version", sys.version)];res.extend(__loaded_modules__());pickle.dumps(res)',
-            ['execute_result'])[0][1]
-        return self.load_pickled(eval(modules['data']['text/plain']))
+        responses = self.sos_kernel.get_response('import sys;sys.stdout.write(__session_info())', ['stream'],
+                                                 name=('stdout',))
+        return [tuple(x) for x in json.loads(''.join(x[1]['text'] for x in responses))]
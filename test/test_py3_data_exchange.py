@@ -5,6 +5,7 @@
 
 import random
 
+import pytest
 from sos_notebook.test_utils import NotebookTest
 
 
@@ -36,6 +37,20 @@ class TestPy3DataExchange(NotebookTest):
             kernel='Python3')
         return notebook.check_output(f'print(repr({var_name}))', kernel='SoS')
 
+    def put_to_Python3(self, notebook, py3_expr, check_expr='repr({})'):
+        # pass variable from kernel Python3 to another Python3 kernel
+        var_name = self._var_name()
+        notebook.call(f'{var_name} = {py3_expr}', kernel='Python3')
+        output = notebook.check_output(
+            f'''\
+            %use py3_dest -l Python3
+            %get {var_name} --from Python3
+            print({check_expr.format(var_name)})
+            ''',
+            kernel='SoS')
+        notebook.call('%use SoS', kernel='SoS')
+        return output
+
     def test_get_none(self, notebook):
         assert 'None' == self.get_from_SoS(notebook, 'None')
 
@@ -133,6 +148,21 @@ class TestPy3DataExchange(NotebookTest):
     def test_put_complex(self, notebook):
         assert "(1+2.2j)" == self.put_to_SoS(notebook, "complex(1, 2.2)")
 
+    def test_get_numpy_array(self, notebook):
+        # numpy arrays are passed as out-of-band buffers with pickle protocol 5
+        pytest.importorskip('numpy')
+        notebook.call('import numpy as np', kernel='SoS')
+        assert 'array([0, 1, 2, 3, 4])' == self.get_from_SoS(notebook, 'np.arange(5)')
+        # restored arrays are writable
+        notebook.call('arr = np.arange(1000000)', kernel='SoS')
+        assert '499999500001' == notebook.check_output(
+            '''\
+            %get arr
+            arr[0] = 1
+            print(arr.sum())
+            ''',
+            kernel='Python3')
+
     def test_get_recursive(self, notebook):
         output = self.get_from_SoS(notebook,
                                    "{'a': 1, 'b': {'c': 3, 'd': 'whatever'}}")
@@ -142,3 +172,45 @@ class TestPy3DataExchange(NotebookTest):
         output = self.put_to_SoS(notebook,
                                  "{'a': 1, 'b': {'c': 3, 'd': 'whatever'}}")
         assert "'a': 1" in output and "'b':" in output and "'c': 3" in output and "'d': 'whatever'" in output
+
+    def test_get_large_repeated(self, notebook):
+        # a large variable is sent, cached by the subkernel when it is sent
+        # again, and then taken from the cache
+        notebook.call('large_var = list(range(1000000))', kernel='SoS')
+        for i in range(3):
+            assert '499999500000' == notebook.check_output(
+                '''\
+                %get large_var
+                print(sum(large_var))
+                ''',
+                kernel='Python3')
+        # a changed variable is not taken from the cache
+        notebook.call('large_var[0] = 1000000', kernel='SoS')
+        assert '499999501000' == notebook.check_output(
+            '''\
+            %get large_var
+            print(sum(large_var))
+            ''',
+            kernel='Python3')
+        # cache lost by the subkernel
+        notebook.call('large_var[0] = 0', kernel='SoS')
+        notebook.call('__sos_cache__.clear()', kernel='Python3')
+        assert '499999500000' == notebook.check_output(
+            '''\
+            %get large_var
+            print(sum(large_var))
+            ''',
+            kernel='Python3')
+
+    def test_put_literal_to_python3(self, notebook):
+        assert "[1.4, True, 'asd', None]" == self.put_to_Python3(
+            notebook, '[1.4, True, "asd", None]')
+        assert "{'a': (1, b'2')}" == self.put_to_Python3(notebook, "{'a': (1, b'2')}")
+
+    def test_put_pickle_to_python3(self, notebook):
+        output = self.put_to_Python3(notebook, "{1.5, 'abc'}")
+        assert "{1.5, 'abc'}" == output or "{'abc', 1.5}" == output
+        assert 'nan' == self.put_to_Python3(notebook, "float('nan')")
+        # long strings and large integers are pickled instead of passed as repr
+        assert '10000000' == self.put_to_Python3(notebook, "b'x' * 10000000", 'len({})')
+        assert '16610' == self.put_to_Python3(notebook, '10 ** 5000', '{}.bit_length()')
@@ -5,6 +5,7 @@
 
 import os
 import tempfile
+import time
 
 import pytest
 from sos_notebook.test_utils import NotebookTest
@@ -89,6 +90,17 @@ class TestPy3Interface(NotebookTest):
         assert 'Unknown variable' in notebook.check_output(
             '%preview -n var[1]', kernel="Python3")
 
+    def test_preview_large_items(self, notebook):
+        '''Test %preview of containers with large items'''
+        notebook.call(
+            'view = {i: list(range(3000000)) for i in range(36)}.values()',
+            kernel="Python3")
+        start = time.time()
+        output = notebook.check_output('%preview -n view', kernel="Python3")
+        # only the beginning of the first item is converted to string
+        assert time.time() - start < 5
+        assert 'dict_values([[0, 1, 2' in output
+
     def test_sessioninfo(self, notebook):
         '''test support for %sessioninfo'''
         notebook.call("print('this is Python3')", kernel="Python3")